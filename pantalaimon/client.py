@@ -115,6 +115,18 @@ def validate_json(instance, schema):
     Validator(schema, format_checker=FormatChecker()).validate(instance)
 
 
+class LazyPformat:
+    """Pretty print an object only once it's formatted into a log message."""
+
+    __slots__ = ("obj",)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return pformat(self.obj)
+
+
 class UnknownRoomError(Exception):
     pass
 
@@ -758,7 +770,7 @@ class PanClient(AsyncClient):
 
         try:
             decrypted_event = self.decrypt_event(event)
-            logger.info("Decrypted event: {}".format(decrypted_event))
+            logger.info("Decrypted event: {}", decrypted_event)
 
             event_dict.update(decrypted_event.source)
             event_dict["decrypted"] = True
@@ -795,7 +807,7 @@ class PanClient(AsyncClient):
                 continue
 
             if event["type"] != "m.room.encrypted":
-                logger.debug("Event is not encrypted: " "\n{}".format(pformat(event)))
+                logger.debug("Event is not encrypted: \n{}", LazyPformat(event))
                 continue
 
             self.pan_decrypt_event(event, ignore_failures=ignore_failures)
@@ -814,15 +826,13 @@ class PanClient(AsyncClient):
         logger.info("Decrypting sync")
         for room_id, room_dict in body["rooms"]["join"].items():
             try:
-                if not self.rooms[room_id].encrypted:
-                    logger.info(
-                        "Room {} is not encrypted skipping...".format(
-                            self.rooms[room_id].display_name
-                        )
-                    )
-                    continue
+                room = self.rooms[room_id]
             except KeyError:
-                logger.info("Unknown room {} skipping...".format(room_id))
+                logger.info("Unknown room {} skipping...", room_id)
+                continue
+
+            if not room.encrypted:
+                logger.info("Room {.display_name} is not encrypted skipping...", room)
                 continue
 
             for event in room_dict["timeline"]["events"]:
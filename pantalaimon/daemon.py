@@ -13,19 +13,27 @@
 # limitations under the License.
 
 import asyncio
+import functools
 import json
 import os
+import re
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from json import JSONDecodeError
 from typing import Any, Dict
 
-import aiohttp
+import aiohttp  # noqa: F401 (used in type comments)
 import attr
 import keyring
-from aiohttp import ClientSession, web
-from aiohttp.client_exceptions import ClientConnectionError, ContentTypeError
+import orjson
+from aiohttp import ClientSession, TCPConnector, web
+from aiohttp.client_exceptions import (
+    ClientConnectionError,
+    ClientPayloadError,
+    ContentTypeError,
+)
 from jsonschema import ValidationError
-from multidict import CIMultiDict
+from multidict import MultiDict  # noqa: F401 (used in type comments)
 from nio import Api, EncryptionError, LoginResponse, OlmTrustError, SendRetryError
 
 from pantalaimon.client import (
@@ -51,11 +59,9 @@ from pantalaimon.thread_messages import (
     DeviceVerifyMessage,
     ExportKeysMessage,
     ImportKeysMessage,
-    SasMessage,
     SendAnywaysMessage,
     StartSasMessage,
     UnverifiedDevicesSignal,
-    UnverifiedResponse,
     UpdateUsersMessage,
     ContinueKeyShare,
     CancelKeyShare,
@@ -69,8 +75,40 @@ CORS_HEADERS = {
     "Access-Control-Allow-Origin": "*",
 }
 
+_MISSING_TOKEN_BODY = orjson.dumps(
+    {"errcode": "M_MISSING_TOKEN", "error": "Missing access token."}
+)
+_UNKNOWN_TOKEN_BODY = orjson.dumps(
+    {"errcode": "M_UNKNOWN_TOKEN", "error": "Unrecognised access token."}
+)
+_NOT_JSON_BODY = orjson.dumps(
+    {"errcode": "M_NOT_JSON", "error": "Request did not contain valid JSON."}
+)
+
+# Integers outside of the 64 bit range are parsed as floats by orjson, which
+# would silently change them. Any of those needs at least 19 digits.
+_LONG_NUMBER = re.compile(rb"\d{19,}")
+
 
-@attr.s
+def json_loads(body):
+    # type: (bytes) -> Any
+    """Parse a JSON body without changing the numbers it contains."""
+    if _LONG_NUMBER.search(body):
+        return json.loads(body)
+
+    return orjson.loads(body)
+
+
+def json_dumps(obj):
+    # type: (Any) -> bytes
+    """Serialize obj, falling back to json for integers orjson can't store."""
+    try:
+        return orjson.dumps(obj)
+    except orjson.JSONEncodeError:
+        return json.dumps(obj).encode()
+
+
+@attr.s(slots=True)
 class ProxyDaemon:
     name = attr.ib()
     homeserver = attr.ib()
@@ -84,6 +122,8 @@ class ProxyDaemon:
 
     decryption_timeout = 10
     unverified_send_timeout = 60
+    chunk_size = 64 * 1024
+    max_cached_filter_size = 64 * 1024
 
     store = attr.ib(type=PanStore, init=False)
     homeserver_url = attr.ib(init=False, default=attr.Factory(dict))
@@ -91,6 +131,9 @@ class ProxyDaemon:
     pan_clients = attr.ib(init=False, default=attr.Factory(dict))
     client_info = attr.ib(init=False, default=attr.Factory(dict), type=dict)
     default_session = attr.ib(init=False, default=None)
+    message_handlers = attr.ib(init=False, default=attr.Factory(dict))
+    _token_to_client = attr.ib(init=False, default=attr.Factory(dict))
+    _inflight_syncs = attr.ib(init=False, default=attr.Factory(dict))
     database_name = "pan.db"
 
     def __attrs_post_init__(self):
@@ -99,27 +142,36 @@ class ProxyDaemon:
         self.homeserver_url = self.homeserver.geturl()
         self.hostname = self.homeserver.hostname
         self.store = PanStore(self.data_dir)
+        self.default_session = self._create_session()
+        self.message_handlers = {
+            DeviceVerifyMessage: self._handle_verify,
+            DeviceUnverifyMessage: self._handle_unverify,
+            DeviceBlacklistMessage: self._handle_blacklist,
+            DeviceUnblacklistMessage: self._handle_unblacklist,
+            StartSasMessage: self._handle_start_sas,
+            AcceptSasMessage: self._handle_accept_sas,
+            ConfirmSasMessage: self._handle_confirm_sas,
+            CancelSasMessage: self._handle_cancel_sas,
+            ExportKeysMessage: self._handle_export,
+            ImportKeysMessage: self._handle_import,
+            SendAnywaysMessage: self._handle_unverified_response,
+            CancelSendingMessage: self._handle_unverified_response,
+            ContinueKeyShare: self._handle_key_share,
+            CancelKeyShare: self._handle_key_share,
+        }
         accounts = self.store.load_users(self.name)
+        tokens = self._load_access_tokens(accounts)
 
-        for user_id, device_id in accounts:
-            if self.conf.keyring:
-                try:
-                    token = keyring.get_password(
-                        "pantalaimon", f"{user_id}-{device_id}-token"
-                    )
-                except RuntimeError as e:
-                    logger.error(e)
-            else:
-                token = self.store.load_access_token(user_id, device_id)
-
+        for (user_id, device_id), token in zip(accounts, tokens):
             if not token:
                 logger.warn(
-                    f"Not restoring client for {user_id} {device_id}, "
-                    f"missing access token."
+                    "Not restoring client for {} {}, missing access token.",
+                    user_id,
+                    device_id,
                 )
                 continue
 
-            logger.info(f"Restoring client for {user_id} {device_id}")
+            logger.info("Restoring client for {} {}", user_id, device_id)
 
             pan_client = PanClient(
                 self.name,
@@ -149,51 +201,110 @@ class ProxyDaemon:
 
             pan_client.start_loop()
 
+    def _load_access_tokens(self, accounts):
+        """Load the access tokens for the given list of accounts.
+
+        Keyring lookups may need a round trip to a secret service, so they are
+        done concurrently if there is more than one account. The first lookup
+        is done on its own, if the keyring is locked it unlocks it and the
+        user only gets a single unlock prompt. The client stores are still
+        loaded one by one since the nio stores share their database models.
+        """
+        if not self.conf.keyring:
+            return [
+                self.store.load_access_token(user_id, device_id)
+                for user_id, device_id in accounts
+            ]
+
+        def get_token(account):
+            user_id, device_id = account
+
+            try:
+                return keyring.get_password(
+                    "pantalaimon", f"{user_id}-{device_id}-token"
+                )
+            except RuntimeError as e:
+                logger.error(e)
+                return None
+
+        if not accounts:
+            return []
+
+        first_token = get_token(accounts[0])
+        rest = accounts[1:]
+
+        if len(rest) <= 1:
+            return [first_token] + [get_token(account) for account in rest]
+
+        with ThreadPoolExecutor(max_workers=min(8, len(rest))) as executor:
+            return [first_token] + list(executor.map(get_token, rest))
+
+    @staticmethod
+    def _create_session():
+        """Create the session that is used to talk to the homeserver.
+
+        All requests go to the same homeserver, so the connection pool isn't
+        limited globally. Idle connections are kept alive for longer than the
+        usual gap between two sync requests of a client.
+        """
+        connector = TCPConnector(
+            limit=0,
+            limit_per_host=256,
+            keepalive_timeout=120,
+            force_close=False,
+            ttl_dns_cache=600,
+            use_dns_cache=True,
+        )
+        return ClientSession(connector=connector)
+
     async def _find_client(self, access_token):
+        client = self._token_to_client.get(access_token, None)
+
+        if client:
+            return client
+
         client_info = self.client_info.get(access_token, None)
 
         if not client_info:
-            async with aiohttp.ClientSession() as session:
-                try:
-                    method, path = Api.whoami(access_token)
-                    resp = await session.request(
-                        method,
-                        self.homeserver_url + path,
-                        proxy=self.proxy,
-                        ssl=self.ssl,
-                    )
-                except ClientConnectionError:
-                    return None
+            try:
+                method, path = Api.whoami(access_token)
+                resp = await self.default_session.request(
+                    method, self.homeserver_url + path, proxy=self.proxy, ssl=self.ssl
+                )
+                body = await resp.read()
+            except ClientConnectionError:
+                return None
 
-                if resp.status != 200:
-                    return None
+            if resp.status != 200:
+                return None
 
-                try:
-                    body = await resp.json()
-                except (JSONDecodeError, ContentTypeError):
-                    return None
+            try:
+                body = orjson.loads(body)
+            except orjson.JSONDecodeError:
+                return None
 
-                try:
-                    user_id = body["user_id"]
-                except KeyError:
-                    return None
+            try:
+                user_id = body["user_id"]
+            except KeyError:
+                return None
 
-                if user_id not in self.pan_clients:
-                    logger.warn(
-                        f"User {user_id} doesn't have a matching pan " f"client."
-                    )
-                    return None
+            if user_id not in self.pan_clients:
+                logger.warn("User {} doesn't have a matching pan client.", user_id)
+                return None
 
-                logger.info(
-                    f"Homeserver confirmed valid access token "
-                    f"for user {user_id}, caching info."
-                )
+            logger.info(
+                "Homeserver confirmed valid access token for user {}, caching info.",
+                user_id,
+            )
 
-                client_info = ClientInfo(user_id, access_token)
-                self.client_info[access_token] = client_info
+            client_info = ClientInfo(user_id, access_token)
+            self.client_info[access_token] = client_info
 
         client = self.pan_clients.get(client_info.user_id, None)
 
+        if client:
+            self._token_to_client[access_token] = client
+
         return client
 
     async def _verify_device(self, message_id, client, device):
@@ -270,119 +381,127 @@ class ProxyDaemon:
         if self.send_queue:
             await self.send_queue.put(message)
 
-    async def receive_message(self, message):
-        client = self.pan_clients.get(message.pan_user)
+    async def _find_device(self, client, message):
+        device = client.device_store[message.user_id].get(message.device_id, None)
 
-        if isinstance(
-            message,
-            (
-                DeviceVerifyMessage,
-                DeviceUnverifyMessage,
-                StartSasMessage,
-                DeviceBlacklistMessage,
-                DeviceUnblacklistMessage,
-            ),
-        ):
+        if not device:
+            msg = f"No device found for {message.user_id} and " f"{message.device_id}"
+            await self.send_response(
+                message.message_id, message.pan_user, "m.unknown_device", msg
+            )
+            logger.info(msg)
 
-            device = client.device_store[message.user_id].get(message.device_id, None)
+        return device
 
-            if not device:
-                msg = (
-                    f"No device found for {message.user_id} and " f"{message.device_id}"
-                )
-                await self.send_response(
-                    message.message_id, message.pan_user, "m.unknown_device", msg
-                )
-                logger.info(msg)
-                return
-
-            if isinstance(message, DeviceVerifyMessage):
-                await self._verify_device(message.message_id, client, device)
-            elif isinstance(message, DeviceUnverifyMessage):
-                await self._unverify_device(message.message_id, client, device)
-            elif isinstance(message, DeviceBlacklistMessage):
-                await self._blacklist_device(message.message_id, client, device)
-            elif isinstance(message, DeviceUnblacklistMessage):
-                await self._unblacklist_device(message.message_id, client, device)
-            elif isinstance(message, StartSasMessage):
-                await client.start_sas(message, device)
-
-        elif isinstance(message, SasMessage):
-            if isinstance(message, AcceptSasMessage):
-                await client.accept_sas(message)
-            elif isinstance(message, ConfirmSasMessage):
-                await client.confirm_sas(message)
-            elif isinstance(message, CancelSasMessage):
-                await client.cancel_sas(message)
-
-        elif isinstance(message, ExportKeysMessage):
-            path = os.path.abspath(os.path.expanduser(message.file_path))
-            logger.info(f"Exporting keys to {path}")
+    async def _handle_verify(self, client, message):
+        device = await self._find_device(client, message)
 
-            try:
-                await client.export_keys(path, message.passphrase)
-            except OSError as e:
-                info_msg = (
-                    f"Error exporting keys for {client.user_id} to" f" {path} {e}"
-                )
-                logger.info(info_msg)
-                await self.send_response(
-                    message.message_id, client.user_id, "m.os_error", str(e)
-                )
+        if device:
+            await self._verify_device(message.message_id, client, device)
 
-            else:
-                info_msg = (
-                    f"Succesfully exported keys for {client.user_id} " f"to {path}"
-                )
-                logger.info(info_msg)
-                await self.send_response(
-                    message.message_id, client.user_id, "m.ok", info_msg
-                )
+    async def _handle_unverify(self, client, message):
+        device = await self._find_device(client, message)
 
-        elif isinstance(message, ImportKeysMessage):
-            path = os.path.abspath(os.path.expanduser(message.file_path))
-            logger.info(f"Importing keys from {path}")
+        if device:
+            await self._unverify_device(message.message_id, client, device)
 
-            try:
-                await client.import_keys(path, message.passphrase)
-            except (OSError, EncryptionError) as e:
-                info_msg = (
-                    f"Error importing keys for {client.user_id} " f"from {path} {e}"
-                )
-                logger.info(info_msg)
-                await self.send_response(
-                    message.message_id, client.user_id, "m.os_error", str(e)
-                )
-            else:
-                info_msg = (
-                    f"Succesfully imported keys for {client.user_id} " f"from {path}"
-                )
-                logger.info(info_msg)
-                await self.send_response(
-                    message.message_id, client.user_id, "m.ok", info_msg
-                )
+    async def _handle_blacklist(self, client, message):
+        device = await self._find_device(client, message)
 
-        elif isinstance(message, UnverifiedResponse):
-            client = self.pan_clients[message.pan_user]
+        if device:
+            await self._blacklist_device(message.message_id, client, device)
 
-            if message.room_id not in client.send_decision_queues:
-                msg = (
-                    f"No send request found for user {message.pan_user} "
-                    f"and room {message.room_id}."
-                )
-                await self.send_response(
-                    message.message_id, message.pan_user, "m.unknown_request", msg
-                )
-                return
+    async def _handle_unblacklist(self, client, message):
+        device = await self._find_device(client, message)
+
+        if device:
+            await self._unblacklist_device(message.message_id, client, device)
+
+    async def _handle_start_sas(self, client, message):
+        device = await self._find_device(client, message)
+
+        if device:
+            await client.start_sas(message, device)
+
+    async def _handle_accept_sas(self, client, message):
+        await client.accept_sas(message)
+
+    async def _handle_confirm_sas(self, client, message):
+        await client.confirm_sas(message)
+
+    async def _handle_cancel_sas(self, client, message):
+        await client.cancel_sas(message)
+
+    async def _handle_export(self, client, message):
+        path = os.path.abspath(os.path.expanduser(message.file_path))
+        logger.info("Exporting keys to {}", path)
+
+        # nio already runs the key derivation and encryption in the default
+        # executor, only loading the sessions from the store happens on the
+        # event loop.
+        try:
+            await client.export_keys(path, message.passphrase)
+        except OSError as e:
+            info_msg = f"Error exporting keys for {client.user_id} to" f" {path} {e}"
+            logger.info(info_msg)
+            await self.send_response(
+                message.message_id, client.user_id, "m.os_error", str(e)
+            )
 
-            queue = client.send_decision_queues[message.room_id]
-            await queue.put(message)
+        else:
+            info_msg = f"Succesfully exported keys for {client.user_id} " f"to {path}"
+            logger.info(info_msg)
+            await self.send_response(
+                message.message_id, client.user_id, "m.ok", info_msg
+            )
 
-        elif isinstance(message, (ContinueKeyShare, CancelKeyShare)):
-            client = self.pan_clients[message.pan_user]
-            await client.handle_key_request_message(message)
+    async def _handle_import(self, client, message):
+        path = os.path.abspath(os.path.expanduser(message.file_path))
+        logger.info("Importing keys from {}", path)
 
-    def get_access_token(self, request):
+        try:
+            await client.import_keys(path, message.passphrase)
+        except (OSError, EncryptionError) as e:
+            info_msg = f"Error importing keys for {client.user_id} " f"from {path} {e}"
+            logger.info(info_msg)
+            await self.send_response(
+                message.message_id, client.user_id, "m.os_error", str(e)
+            )
+        else:
+            info_msg = f"Succesfully imported keys for {client.user_id} " f"from {path}"
+            logger.info(info_msg)
+            await self.send_response(
+                message.message_id, client.user_id, "m.ok", info_msg
+            )
+
+    async def _handle_unverified_response(self, client, message):
+        if message.room_id not in client.send_decision_queues:
+            msg = (
+                f"No send request found for user {message.pan_user} "
+                f"and room {message.room_id}."
+            )
+            await self.send_response(
+                message.message_id, message.pan_user, "m.unknown_request", msg
+            )
+            return
+
+        queue = client.send_decision_queues[message.room_id]
+        await queue.put(message)
+
+    async def _handle_key_share(self, client, message):
+        await client.handle_key_request_message(message)
+
+    async def receive_message(self, message):
+        handler = self.message_handlers.get(type(message), None)
+
+        if not handler:
+            return
+
+        client = self.pan_clients.get(message.pan_user)
+        await handler(client, message)
+
+    @staticmethod
+    def get_access_token(request):
         # type: (aiohttp.web.BaseRequest) -> str
         """Extract the access token from the request.
 
@@ -394,40 +513,81 @@ class ProxyDaemon:
         access_token = request.query.get("access_token", "")
 
         if not access_token:
-            access_token = request.headers.get("Authorization", "").strip("Bearer ")
+            authorization = request.headers.get("Authorization", "")
+
+            if authorization.startswith("Bearer "):
+                access_token = authorization[7:]
 
         return access_token
 
-    def sanitize_filter(self, sync_filter):
+    @staticmethod
+    def sanitize_filter(sync_filter):
         # type: (Dict[Any, Any]) -> Dict[Any, Any]
         """Make sure that a filter isn't filtering encrypted messages."""
-        sync_filter = dict(sync_filter)
-        room_filter = sync_filter.get("room", None)
+        timeline_filter = (sync_filter.get("room") or {}).get("timeline") or {}
+        types_filter = timeline_filter.get("types", None)
+        not_types_filter = timeline_filter.get("not_types", None)
 
-        if room_filter:
-            timeline_filter = room_filter.get("timeline", None)
+        # Most filters don't touch encrypted events, return those untouched.
+        if (not types_filter or "m.room.encrypted" in types_filter) and (
+            not not_types_filter or "m.room.encrypted" not in not_types_filter
+        ):
+            return sync_filter
 
-            if timeline_filter:
-                types_filter = timeline_filter.get("types", None)
+        if types_filter and "m.room.encrypted" not in types_filter:
+            types_filter.append("m.room.encrypted")
 
-                if types_filter:
-                    if "m.room.encrypted" not in types_filter:
-                        types_filter.append("m.room.encrypted")
+        if not_types_filter:
+            try:
+                not_types_filter.remove("m.room.encrypted")
+            except ValueError:
+                pass
+
+        return dict(sync_filter)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=512)
+    def _sanitized_filter_str(sync_filter):
+        # type: (str) -> str
+        """Sanitize a filter that was passed to sync as a query parameter.
+
+        Clients send the same filter with every sync request, so the result is
+        cached. Filter ids are returned unchanged.
+        """
+        try:
+            filter_obj = json_loads(sync_filter.encode())
+        except ValueError:
+            return sync_filter
 
-                not_types_filter = timeline_filter.get("not_types", None)
+        if not isinstance(filter_obj, dict):
+            return sync_filter
+
+        return json_dumps(ProxyDaemon.sanitize_filter(filter_obj)).decode()
+
+    @staticmethod
+    @functools.lru_cache(maxsize=64)
+    def _sanitized_filter_body(body):
+        # type: (bytes) -> bytes
+        """Sanitize the body of a filter upload.
+
+        Clients upload the same filter every time they start, so the result is
+        cached by the raw body. Callers should only use the cache for bodies
+        up to max_cached_filter_size, larger ones can be sanitized uncached
+        using __wrapped__.
+
+        Raises ValueError if the body isn't a JSON object.
+        """
+        filter_obj = json_loads(body)
 
-                if not_types_filter:
-                    try:
-                        not_types_filter.remove("m.room.encrypted")
-                    except ValueError:
-                        pass
+        if not isinstance(filter_obj, dict):
+            raise ValueError("The filter isn't a JSON object.")
 
-        return sync_filter
+        return json_dumps(ProxyDaemon.sanitize_filter(filter_obj))
 
     async def forward_request(
         self,
         request,  # type: aiohttp.web.BaseRequest
-        params=None,  # type: CIMultiDict
+        params=None,  # type: MultiDict
         data=None,  # type: bytes
         session=None,  # type: aiohttp.ClientSession
         token=None,  # type: str
@@ -438,7 +598,7 @@ class ProxyDaemon:
         Args:
             request (aiohttp.BaseRequest): The request that should be
                 forwarded.
-            params (CIMultiDict, optional): The query parameters for the
+            params (MultiDict, optional): The query parameters for the
                 request.
             data (Dict, optional): Data for the request.
             session (aiohttp.ClientSession, optional): The client session that
@@ -446,20 +606,17 @@ class ProxyDaemon:
             token (str, optional): The access token that should be used for the
                 request.
         """
-        if not session:
-            if not self.default_session:
-                self.default_session = ClientSession()
-            session = self.default_session
+        session = session or self.default_session
 
         assert session
 
         path = urllib.parse.quote(request.path)  # re-encode path stuff like room aliases
         method = request.method
 
-        headers = CIMultiDict(request.headers)
-        headers.pop("Host", None)
+        headers = request.headers.copy()
+        headers.popall("Host", None)
 
-        params = params or CIMultiDict(request.query)
+        params = params or request.query.copy()
 
         if token:
             if "Authorization" in headers:
@@ -486,16 +643,21 @@ class ProxyDaemon:
     async def forward_to_web(
         self, request, params=None, data=None, session=None, token=None
     ):
-        """Forward the given request and convert the response to a Response.
+        """Forward the given request and stream the response back.
 
-        If there is a exception raised by the client session this method
-        returns a Response with a 500 status code and the text set to the error
-        message of the exception.
+        The response body is passed through in chunks, so large bodies, e.g.
+        media downloads, are never fully held in memory.
+
+        If there is a exception raised by the client session while sending the
+        request this method returns a Response with a 500 status code and the
+        text set to the error message of the exception. Errors while the body
+        is streamed can only be logged, the connection to the client is closed
+        once the response is finished.
 
         Args:
             request (aiohttp.BaseRequest): The request that should be
                 forwarded.
-            params (CIMultiDict, optional): The query parameters for the
+            params (MultiDict, optional): The query parameters for the
                 request.
             data (Dict, optional): Data for the request.
             session (aiohttp.ClientSession, optional): The client session that
@@ -507,15 +669,36 @@ class ProxyDaemon:
             response = await self.forward_request(
                 request, params=params, data=data, session=session, token=token
             )
-            return web.Response(
-                status=response.status,
-                content_type=response.content_type,
-                headers=CORS_HEADERS,
-                body=await response.read(),
-            )
         except ClientConnectionError as e:
             return web.Response(status=500, text=str(e))
 
+        try:
+            web_response = web.StreamResponse(
+                status=response.status, headers=CORS_HEADERS
+            )
+            web_response.content_type = response.content_type
+
+            # aiohttp decompresses encoded bodies, the upstream length only
+            # matches if the body wasn't encoded.
+            if "Content-Encoding" not in response.headers:
+                web_response.content_length = response.content_length
+
+            await web_response.prepare(request)
+
+            async for chunk in response.content.iter_chunked(self.chunk_size):
+                await web_response.write(chunk)
+
+            await web_response.write_eof()
+        except (ClientPayloadError, ClientConnectionError, ConnectionResetError) as e:
+            logger.warn(
+                "Error while streaming the response for {}: {}", request.path, e
+            )
+            web_response.force_close()
+        finally:
+            response.release()
+
+        return web_response
+
     async def router(self, request):
         """Catchall request router."""
         return await self.forward_to_web(request)
@@ -540,9 +723,10 @@ class ProxyDaemon:
 
         if user_id in self.pan_clients:
             logger.info(
-                f"Background sync client already exists for {user_id},"
-                f" not starting new one"
+                "Background sync client already exists for {}, not starting new one",
+                user_id,
             )
+            self._token_to_client[access_token] = self.pan_clients[user_id]
             return
 
         pan_client = PanClient(
@@ -563,13 +747,14 @@ class ProxyDaemon:
             await pan_client.close()
             return
 
-        logger.info(f"Succesfully started new background sync client for " f"{user_id}")
+        logger.info("Succesfully started new background sync client for {}", user_id)
 
         await self.send_ui_message(
             UpdateUsersMessage(self.name, user_id, pan_client.device_id)
         )
 
         self.pan_clients[user_id] = pan_client
+        self._token_to_client[access_token] = pan_client
 
         if self.conf.keyring:
             try:
@@ -610,16 +795,18 @@ class ProxyDaemon:
         user = self._get_login_user(body)
         password = body.get("password", "")
 
-        logger.info(f"New user logging in: {user}")
+        logger.info("New user logging in: {}", user)
 
         try:
             response = await self.forward_request(request)
         except ClientConnectionError as e:
             return web.Response(status=500, text=str(e))
 
+        body = await response.read()
+
         try:
-            json_response = await response.json()
-        except (JSONDecodeError, ContentTypeError):
+            json_response = orjson.loads(body)
+        except orjson.JSONDecodeError:
             json_response = None
 
         if response.status == 200 and json_response:
@@ -628,44 +815,60 @@ class ProxyDaemon:
 
             if user_id and access_token:
                 logger.info(
-                    f"User: {user} succesfully logged in, starting "
-                    f"a background sync client."
+                    "User: {} succesfully logged in, starting a background sync "
+                    "client.",
+                    user,
                 )
                 await self.start_pan_client(access_token, user, user_id, password)
 
+        return self._passthrough(response, body)
+
+    @staticmethod
+    def _missing_token():
         return web.Response(
-            status=response.status,
-            content_type=response.content_type,
+            status=401,
+            content_type="application/json",
             headers=CORS_HEADERS,
-            body=await response.read(),
+            body=_MISSING_TOKEN_BODY,
         )
 
-    @property
-    def _missing_token(self):
-        return web.json_response(
-            {"errcode": "M_MISSING_TOKEN", "error": "Missing access token."},
-            headers=CORS_HEADERS,
+    @staticmethod
+    def _unknown_token():
+        return web.Response(
             status=401,
+            content_type="application/json",
+            headers=CORS_HEADERS,
+            body=_UNKNOWN_TOKEN_BODY,
         )
 
-    @property
-    def _unknown_token(self):
-        return web.json_response(
-            {"errcode": "M_UNKNOWN_TOKEN", "error": "Unrecognised access token."},
+    @staticmethod
+    def _not_json():
+        return web.Response(
+            status=400,
+            content_type="application/json",
             headers=CORS_HEADERS,
-            status=401,
+            body=_NOT_JSON_BODY,
         )
 
-    @property
-    def _not_json(self):
-        return web.json_response(
-            {"errcode": "M_NOT_JSON", "error": "Request did not contain valid JSON."},
-            headers=CORS_HEADERS,
-            status=400,
+    @staticmethod
+    def _passthrough(response, body):
+        """Pass an already read upstream response back to the client.
+
+        The upstream Content-Type header is copied as is instead of letting
+        aiohttp parse and rebuild it.
+        """
+        headers = dict(CORS_HEADERS)
+        headers["Content-Type"] = response.headers.get(
+            "Content-Type", "application/octet-stream"
         )
 
+        return web.Response(status=response.status, headers=headers, body=body)
+
     async def decrypt_body(self, client, body, sync=True):
         """Try to decrypt the a sync or messages body."""
+        # Decryption stays on the event loop, the Olm machine and the store it
+        # uses are shared with the pan client's sync loop and aren't thread
+        # safe.
         decryption_method = (
             client.decrypt_sync_body if sync else client.decrypt_messages_body
         )
@@ -673,12 +876,12 @@ class ProxyDaemon:
         async def decrypt_loop(client, body):
             while True:
                 try:
-                    logger.info("Trying to decrypt sync")
+                    logger.debug("Trying to decrypt sync")
                     return decryption_method(body, ignore_failures=False)
                 except EncryptionError:
                     logger.info("Error decrypting sync, waiting for next pan " "sync")
-                    await client.synced.wait(),
-                    logger.info("Pan synced, retrying decryption.")
+                    await client.synced.wait()
+                    logger.debug("Pan synced, retrying decryption.")
 
         try:
             return await asyncio.wait_for(
@@ -692,26 +895,45 @@ class ProxyDaemon:
         access_token = self.get_access_token(request)
 
         if not access_token:
-            return self._missing_token
+            return self._missing_token()
 
         client = await self._find_client(access_token)
         if not client:
-            return self._unknown_token
+            return self._unknown_token()
 
         sync_filter = request.query.get("filter", None)
-        query = CIMultiDict(request.query)
+        query = request.query.copy()
 
         if sync_filter:
-            try:
-                sync_filter = json.loads(sync_filter)
-            except (JSONDecodeError, TypeError):
-                pass
+            query["filter"] = self._sanitized_filter_str(sync_filter)
+
+        # Concurrent identical sync requests for the same pan user, e.g. from
+        # multiple clients of the same user, share a single upstream request.
+        key = (
+            client.user_id,
+            tuple(sorted((k, v) for k, v in query.items() if k != "access_token")),
+        )
+        task = self._inflight_syncs.get(key, None)
+
+        if not task or task.done():
+            task = asyncio.ensure_future(self._forward_sync(request, client, query))
+            self._inflight_syncs[key] = task
+
+            def discard(task):
+                # A newer request may have replaced us already.
+                if self._inflight_syncs.get(key) is task:
+                    del self._inflight_syncs[key]
 
-            if isinstance(sync_filter, dict):
-                sync_filter = json.dumps(self.sanitize_filter(sync_filter))
+            task.add_done_callback(discard)
 
-            query["filter"] = sync_filter
+        response = await asyncio.shield(task)
 
+        # Responses can't be sent more than once, give every request its own.
+        return web.Response(
+            status=response.status, headers=response.headers, body=response.body
+        )
+
+    async def _forward_sync(self, request, client, query):
         try:
             response = await self.forward_request(
                 request, params=query, token=client.access_token
@@ -719,68 +941,72 @@ class ProxyDaemon:
         except ClientConnectionError as e:
             return web.Response(status=500, text=str(e))
 
+        body = await response.read()
+
         if response.status == 200:
             try:
-                json_response = await response.json()
+                json_response = json_loads(body)
+            except ValueError:
+                json_response = None
+
+            if json_response is not None:
                 json_response = await self.decrypt_body(client, json_response)
 
-                return web.json_response(
-                    json_response, headers=CORS_HEADERS, status=response.status
+                return web.Response(
+                    status=response.status,
+                    content_type="application/json",
+                    headers=CORS_HEADERS,
+                    body=json_dumps(json_response),
                 )
-            except (JSONDecodeError, ContentTypeError):
-                pass
 
-        return web.Response(
-            status=response.status,
-            content_type=response.content_type,
-            headers=CORS_HEADERS,
-            body=await response.read(),
-        )
+        return self._passthrough(response, body)
 
     async def messages(self, request):
         access_token = self.get_access_token(request)
 
         if not access_token:
-            return self._missing_token
+            return self._missing_token()
 
         client = await self._find_client(access_token)
         if not client:
-            return self._unknown_token
+            return self._unknown_token()
 
         try:
             response = await self.forward_request(request)
         except ClientConnectionError as e:
             return web.Response(status=500, text=str(e))
 
+        body = await response.read()
+
         if response.status == 200:
             try:
-                json_response = await response.json()
+                json_response = json_loads(body)
+            except ValueError:
+                json_response = None
+
+            if json_response is not None:
                 json_response = await self.decrypt_body(
                     client, json_response, sync=False
                 )
 
-                return web.json_response(
-                    json_response, headers=CORS_HEADERS, status=response.status
+                return web.Response(
+                    status=response.status,
+                    content_type="application/json",
+                    headers=CORS_HEADERS,
+                    body=json_dumps(json_response),
                 )
-            except (JSONDecodeError, ContentTypeError):
-                pass
 
-        return web.Response(
-            status=response.status,
-            content_type=response.content_type,
-            headers=CORS_HEADERS,
-            body=await response.read(),
-        )
+        return self._passthrough(response, body)
 
     async def send_message(self, request):
         access_token = self.get_access_token(request)
 
         if not access_token:
-            return self._missing_token
+            return self._missing_token()
 
         client = await self._find_client(access_token)
         if not client:
-            return self._unknown_token
+            return self._unknown_token()
 
         room_id = request.match_info["room_id"]
 
@@ -807,7 +1033,7 @@ class ProxyDaemon:
         try:
             content = await request.json()
         except (JSONDecodeError, ContentTypeError):
-            return self._not_json
+            return self._not_json()
 
         async def _send(ignore_unverified=False):
             try:
@@ -815,11 +1041,9 @@ class ProxyDaemon:
                     room_id, msgtype, content, txnid, ignore_unverified
                 )
 
-                return web.Response(
-                    status=response.transport_response.status,
-                    content_type=response.transport_response.content_type,
-                    headers=CORS_HEADERS,
-                    body=await response.transport_response.read(),
+                return self._passthrough(
+                    response.transport_response,
+                    await response.transport_response.read(),
                 )
             except ClientConnectionError as e:
                 return web.Response(status=500, text=str(e))
@@ -912,16 +1136,22 @@ class ProxyDaemon:
         access_token = self.get_access_token(request)
 
         if not access_token:
-            return self._missing_token
+            return self._missing_token()
 
-        try:
-            content = await request.json()
-        except (JSONDecodeError, ContentTypeError):
-            return self._not_json
+        body = await request.read()
+
+        # The cache keeps the raw body alive, don't let large bodies fill it.
+        if len(body) <= self.max_cached_filter_size:
+            sanitize = self._sanitized_filter_body
+        else:
+            sanitize = self._sanitized_filter_body.__wrapped__
 
-        sanitized_content = self.sanitize_filter(content)
+        try:
+            sanitized_content = sanitize(body)
+        except ValueError:
+            return self._not_json()
 
-        return await self.forward_to_web(request, data=json.dumps(sanitized_content))
+        return await self.forward_to_web(request, data=sanitized_content)
 
     async def search_opts(self, request):
         return web.json_response({}, headers=CORS_HEADERS)
@@ -930,7 +1160,7 @@ class ProxyDaemon:
         access_token = self.get_access_token(request)
 
         if not access_token:
-            return self._missing_token
+            return self._missing_token()
 
         if not INDEXING_ENABLED:
             return await self.forward_to_web(request)
@@ -938,12 +1168,12 @@ class ProxyDaemon:
         client = await self._find_client(access_token)
 
         if not client:
-            return self._unknown_token
+            return self._unknown_token()
 
         try:
             content = await request.json()
         except (JSONDecodeError, ContentTypeError):
-            return self._not_json
+            return self._not_json()
 
         try:
             validate_json(content, SEARCH_TERMS_SCHEMA)
@@ -990,12 +1220,30 @@ class ProxyDaemon:
     async def shutdown(self, _):
         """Shut the daemon down closing all the client sessions it has.
 
-        This method is called when we shut the whole app down.
+        This method is called when we shut the whole app down. The clients
+        are independent of each other so they are all stopped concurrently.
+        Shared syncs that are still in flight are cancelled first, they would
+        otherwise keep using the clients and the session we close.
         """
-        for client in self.pan_clients.values():
+        inflight_syncs = list(self._inflight_syncs.values())
+
+        for task in inflight_syncs:
+            task.cancel()
+
+        await asyncio.gather(*inflight_syncs, return_exceptions=True)
+
+        async def shutdown_client(client):
             await client.loop_stop()
             await client.close()
 
+        tasks = [shutdown_client(client) for client in self.pan_clients.values()]
+
         if self.default_session:
-            await self.default_session.close()
+            tasks.append(self.default_session.close())
             self.default_session = None
+
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error("Error while shutting down: {}", result)
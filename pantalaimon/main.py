@@ -15,6 +15,7 @@
 import asyncio
 import os
 import signal
+from importlib import util
 from typing import Optional
 
 import click
@@ -134,6 +135,13 @@ async def message_router(receive_queue, send_queue, proxies):
 @click.option("--data-path", type=click.Path(exists=True))
 @click.pass_context
 def main(context, log_level, debug_encryption, config, data_path):
+    # Use the faster libuv based event loop if it's installed.
+    if util.find_spec("uvloop"):
+        import uvloop
+
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        asyncio.set_event_loop(asyncio.new_event_loop())
+
     loop = asyncio.get_event_loop()
 
     conf_dir = user_config_dir("pantalaimon", "")
@@ -24,6 +24,7 @@ setup(
         "click",
         "keyring",
         "logbook",
+        "orjson",
         "peewee",
         "janus",
         "prompt_toolkit",
@@ -34,6 +35,9 @@ setup(
         "e2e_search":  [
             "tantivy",
         ],
+        "uvloop": [
+            "uvloop",
+        ],
         "ui": [
             "dbus-python",
             "PyGObject",
@@ -145,6 +145,7 @@ async def pan_proxy_server(tempdir, aiohttp_server):
         web.post("/_matrix/client/r0/search", proxy.search),
         web.options("/_matrix/client/r0/search", proxy.search_opts),
     ])
+    app.router.add_route("*", "/" + "{proxyPath:.*}", proxy.router)
 
     server = await aiohttp_server(app)
 
@@ -1,12 +1,20 @@
 import asyncio
 import json
 import re
+import threading
+import time
 from collections import defaultdict
 
+import keyring
+import pytest
 from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+from nio import EncryptionError
 from nio.crypto import OlmDevice
+from nio.rooms import MatrixRoom
 
 from conftest import faker
+from pantalaimon.daemon import ProxyDaemon
 from pantalaimon.thread_messages import UpdateDevicesMessage, UpdateUsersMessage
 
 BOB_ID = "@bob:example.org"
@@ -208,3 +216,296 @@ class TestClass(object):
         assert isinstance(message, UpdateDevicesMessage)
 
         assert BOB_DEVICE in message.devices[BOB_ID]
+
+    def test_sync_filter_sanitizing(self):
+        sync_filter = json.dumps({
+            "room": {
+                "timeline": {
+                    "types": ["m.room.message"],
+                    "not_types": ["m.room.encrypted"],
+                }
+            }
+        })
+
+        sanitized = json.loads(ProxyDaemon._sanitized_filter_str(sync_filter))
+        timeline_filter = sanitized["room"]["timeline"]
+
+        assert "m.room.encrypted" in timeline_filter["types"]
+        assert "m.room.encrypted" not in timeline_filter["not_types"]
+
+        # Filter ids are passed through unchanged.
+        assert ProxyDaemon._sanitized_filter_str("1") == "1"
+        assert ProxyDaemon._sanitized_filter_str("some_id") == "some_id"
+
+    def test_access_token_parsing(self):
+        request = make_mocked_request(
+            "GET", "/_matrix/client/r0/sync", headers={"Authorization": "Bearer abc"}
+        )
+        assert ProxyDaemon.get_access_token(request) == "abc"
+
+        # Tokens starting or ending with characters from "Bearer " must be
+        # kept intact.
+        request = make_mocked_request(
+            "GET",
+            "/_matrix/client/r0/sync",
+            headers={"Authorization": "Bearer aBear"},
+        )
+        assert ProxyDaemon.get_access_token(request) == "aBear"
+
+        request = make_mocked_request(
+            "GET", "/_matrix/client/r0/sync?access_token=xyz"
+        )
+        assert ProxyDaemon.get_access_token(request) == "xyz"
+
+    def test_filter_upload_sanitizing(self):
+        body = json.dumps({
+            "room": {"timeline": {"not_types": ["m.room.encrypted"]}}
+        }).encode()
+
+        sanitized = json.loads(ProxyDaemon._sanitized_filter_body(body))
+        assert sanitized["room"]["timeline"]["not_types"] == []
+
+        body = b'{"room": {"timeline": {"limit": 18446744073709551617}}}'
+        sanitized = json.loads(ProxyDaemon._sanitized_filter_body(body))
+        assert sanitized["room"]["timeline"]["limit"] == 2 ** 64 + 1
+
+        with pytest.raises(ValueError):
+            ProxyDaemon._sanitized_filter_body(b"not json")
+
+        with pytest.raises(ValueError):
+            ProxyDaemon._sanitized_filter_body(b"[]")
+
+    async def test_forwarded_media(self, pan_proxy_server, aiohttp_client, aioresponse):
+        server, _, _ = pan_proxy_server
+
+        client = await aiohttp_client(server)
+
+        media = b"\x89PNG" + b"a" * 200000
+
+        aioresponse.get(
+            "https://example.org/_matrix/media/r0/download/example.org/abc",
+            status=200,
+            body=media,
+            content_type="image/png",
+            headers={"Content-Length": str(len(media))},
+        )
+
+        resp = await client.get("/_matrix/media/r0/download/example.org/abc")
+
+        assert resp.status == 200
+        assert resp.content_type == "image/png"
+        assert resp.content_length == len(media)
+        assert await resp.read() == media
+
+    async def test_decryption_during_key_query(self, running_proxy, aioresponse):
+        _, _, proxy, _ = running_proxy
+        pan_client = list(proxy.pan_clients.values())[0]
+
+        room = MatrixRoom("!test:example.org", pan_client.user_id, encrypted=True)
+        room.add_member(BOB_ID, None, None)
+        pan_client.rooms[room.room_id] = room
+
+        aioresponse.post(
+            re.compile(r"^https://example\.org/_matrix/client/r0/keys/query\?.*"),
+            status=200,
+            payload={"device_keys": {}, "failures": {}},
+        )
+
+        loop_thread = threading.get_ident()
+        decrypt_threads = []
+
+        def decrypt_sync_body(body, ignore_failures=True):
+            decrypt_threads.append((threading.get_ident(), ignore_failures))
+            # Decryption touches the same Olm state as the key query.
+            pan_client.olm.users_for_key_query.add(BOB_ID)
+
+            if len(decrypt_threads) == 1:
+                raise EncryptionError("Missing session")
+
+            return body
+
+        pan_client.decrypt_sync_body = decrypt_sync_body
+
+        async def sync_loop():
+            # Let the decryption fail once and wait for our sync.
+            while not decrypt_threads:
+                await asyncio.sleep(0)
+
+            await pan_client.keys_query()
+            pan_client.synced.set()
+            pan_client.synced.clear()
+
+        body = {"next_batch": "abc"}
+
+        decrypted, _ = await asyncio.gather(
+            proxy.decrypt_body(pan_client, body), sync_loop()
+        )
+
+        assert decrypted == body
+        # Olm state isn't thread safe, decryption has to stay on the event
+        # loop next to the sync loop.
+        assert decrypt_threads == [(loop_thread, False), (loop_thread, False)]
+
+    async def test_sync_deduplication(self, running_proxy, aioresponse):
+        _, aioclient, _, _ = running_proxy
+
+        upstream_calls = 0
+        release = asyncio.Event()
+
+        async def sync_callback(url, **kwargs):
+            nonlocal upstream_calls
+            upstream_calls += 1
+            await release.wait()
+
+        aioresponse.get(
+            re.compile(r"^https://example\.org/_matrix/client/r0/sync\?.*since=s1.*"),
+            status=200,
+            payload={"next_batch": "s2", "rooms": {"join": {}}},
+            callback=sync_callback,
+            repeat=True,
+        )
+
+        url = "/_matrix/client/r0/sync?access_token=abc123&since=s1"
+
+        async def wait_for_upstream():
+            while not upstream_calls:
+                await asyncio.sleep(0)
+            # Give the other requests time to join the upstream request.
+            await asyncio.sleep(0.1)
+
+        first = asyncio.ensure_future(aioclient.get(url))
+        second = asyncio.ensure_future(aioclient.get(url))
+        await wait_for_upstream()
+        release.set()
+
+        for response in await asyncio.gather(first, second):
+            assert response.status == 200
+            assert (await response.json())["next_batch"] == "s2"
+
+        assert upstream_calls == 1
+
+        # A disconnecting client doesn't take the shared request down with it.
+        upstream_calls = 0
+        release.clear()
+
+        first = asyncio.ensure_future(aioclient.get(url))
+        second = asyncio.ensure_future(aioclient.get(url))
+        await wait_for_upstream()
+
+        first.cancel()
+        await asyncio.sleep(0.1)
+        release.set()
+
+        response = await second
+        assert response.status == 200
+        assert (await response.json())["next_batch"] == "s2"
+        assert upstream_calls == 1
+
+    async def test_large_filter_upload(self, pan_proxy_server, aiohttp_client, aioresponse):
+        server, proxy, _ = pan_proxy_server
+
+        client = await aiohttp_client(server)
+
+        filter_url = re.compile(
+            r"^https://example\.org/_matrix/client/r0/user/.*/filter\?.*"
+        )
+        aioresponse.post(filter_url, status=200, payload={"filter_id": "1"})
+
+        sync_filter = {
+            "room": {"timeline": {"not_types": ["m.room.encrypted"]}},
+            "padding": "a" * proxy.max_cached_filter_size,
+        }
+
+        ProxyDaemon._sanitized_filter_body.cache_clear()
+
+        resp = await client.post(
+            "/_matrix/client/r0/user/@example:example.org/filter?access_token=abc123",
+            json=sync_filter,
+        )
+
+        assert resp.status == 200
+        assert await resp.json() == {"filter_id": "1"}
+        assert ProxyDaemon._sanitized_filter_body.cache_info().currsize == 0
+
+        upload = list(aioresponse.requests.values())[0][0]
+        sanitized = json.loads(upload.kwargs["data"])
+        assert sanitized["room"]["timeline"]["not_types"] == []
+
+    async def test_sync_keeps_large_integers(self, running_proxy, aioresponse):
+        _, aioclient, _, _ = running_proxy
+
+        large_number = 2 ** 64 + 1
+
+        aioresponse.get(
+            re.compile(r"^https://example\.org/_matrix/client/r0/sync\?.*since=s1.*"),
+            status=200,
+            body='{"next_batch": "s2", "rooms": {"join": {}}, "x": %d}' % large_number,
+            content_type="application/json",
+        )
+
+        resp = await aioclient.get(
+            "/_matrix/client/r0/sync?access_token=abc123&since=s1"
+        )
+
+        assert resp.status == 200
+        assert json.loads(await resp.text())["x"] == large_number
+
+    async def test_shutdown_cancels_inflight_syncs(self, running_proxy, aioresponse):
+        _, aioclient, proxy, _ = running_proxy
+
+        forwarded = asyncio.Event()
+
+        async def sync_callback(url, **kwargs):
+            forwarded.set()
+            # The homeserver never answers.
+            await asyncio.Event().wait()
+
+        aioresponse.get(
+            re.compile(r"^https://example\.org/_matrix/client/r0/sync\?.*since=s1.*"),
+            status=200,
+            payload={"next_batch": "s2", "rooms": {"join": {}}},
+            callback=sync_callback,
+        )
+
+        request = asyncio.ensure_future(
+            aioclient.get("/_matrix/client/r0/sync?access_token=abc123&since=s1")
+        )
+        await forwarded.wait()
+
+        inflight_syncs = list(proxy._inflight_syncs.values())
+        assert len(inflight_syncs) == 1
+
+        await proxy.shutdown(None)
+
+        assert inflight_syncs[0].cancelled()
+        assert not proxy._inflight_syncs
+
+        request.cancel()
+        await asyncio.gather(request, return_exceptions=True)
+
+    async def test_access_token_loading(self, pan_proxy_server, monkeypatch):
+        _, proxy, _ = pan_proxy_server
+
+        accounts = [("@user{}:example.org".format(i), "DEVICEID") for i in range(4)]
+        first_done = threading.Event()
+        lookups = []
+
+        def get_password(service, username):
+            if username.startswith(accounts[0][0]):
+                # Unlocking the keyring takes a while.
+                time.sleep(0.05)
+                first_done.set()
+            else:
+                lookups.append(first_done.is_set())
+
+            return username
+
+        monkeypatch.setattr(keyring, "get_password", get_password)
+
+        tokens = proxy._load_access_tokens(accounts)
+
+        assert tokens == [
+            "{}-{}-token".format(user_id, device_id) for user_id, device_id in accounts
+        ]
+        # The other lookups only start once the first one unlocked the keyring.
+        assert lookups == [True, True, True]